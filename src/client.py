@@ -2,66 +2,198 @@
 """
 
 from argparse import ArgumentParser
+from base64 import b64encode, b64decode
 from dataclasses import dataclass, field
-from json import dumps, loads
-from socket import socket, AF_INET, SOCK_STREAM
+from json import dumps as json_dumps, loads as json_loads
+from os import chmod
+from pathlib import Path
+from queue import Queue
+from socket import socket, AF_INET, SOCK_STREAM, IPPROTO_TCP, TCP_NODELAY
+from threading import Thread
 
 from logging import basicConfig, getLogger
-from phe import paillier, PaillierPublicKey, PaillierPrivateKey, EncryptedNumber
-from pyope.ope import OPE
+from orjson import dumps, loads
+from phe import paillier, PaillierPublicKey, PaillierPrivateKey, EncodedNumber, EncryptedNumber
+from phe.util import HAVE_GMP
+from pyope.ope import OPE, ValueRange
 from rich.console import Console
+from rich.highlighter import NullHighlighter
 from rich.logging import RichHandler
 
 basicConfig(
     level='INFO',
     format="%(message)s",
     datefmt="[%Y-%m-%dT%H:%M:%S]",
-    handlers=[RichHandler(console=Console(stderr=True))],
+    handlers=[RichHandler(console=Console(stderr=True), markup=False, highlighter=NullHighlighter())],
 )
 
 _LOGGER = getLogger('client')
 VERSION = '1.0.0'
+PHE_KEY_LENGTH = 2048
+KEY_CACHE_PATH = Path.home() / '.cache' / 'ensibs_db_security' / 'paillier_keys.json'
+OBFUSCATOR_POOL_SIZE = 16
+OPE_IN_RANGE = ValueRange(0, 10**8)
+OPE_OUT_RANGE = ValueRange(0, 2**48)
 
 
-@dataclass
+def _send_msg(sock: socket, payload: bytes):
+    """Send a message prefixed with its 4-byte big-endian length"""
+    sock.sendall(len(payload).to_bytes(4, 'big') + payload)
+
+
+def _recv_into(sock: socket, view: memoryview):
+    """Receive exactly len(view) bytes from a socket into a buffer"""
+    size = len(view)
+    received = 0
+    while received < size:
+        read = sock.recv_into(view[received:])
+        if read == 0:
+            raise ConnectionError("connection closed while receiving")
+        received += read
+
+
+def _recv_exact(sock: socket, size: int) -> bytes:
+    """Receive exactly size bytes from a socket"""
+    buffer = bytearray(size)
+    _recv_into(sock, memoryview(buffer))
+    return bytes(buffer)
+
+
+def _recv_msg(sock: socket) -> bytes:
+    """Receive a message prefixed with its 4-byte big-endian length"""
+    size = int.from_bytes(_recv_exact(sock, 4), 'big')
+    return _recv_exact(sock, size)
+
+
+def _int_to_b64(value: int, n_bits: int) -> str:
+    """Encode an n_bits-wide integer as base64 big-endian bytes"""
+    return b64encode(value.to_bytes((n_bits + 7) // 8, 'big')).decode('ascii')
+
+
+def _b64_to_int(encoded: str) -> int:
+    """Decode a base64 big-endian bytes integer"""
+    return int.from_bytes(b64decode(encoded), 'big')
+
+
+@dataclass(slots=True)
 class Keys:
     """Encryption keys object"""
 
     phe_public_key: PaillierPublicKey
     phe_private_key: PaillierPrivateKey
     ope_key: OPE
-
-    def __init__(self):
-        self.generate()
+    _obfuscators: Queue
+
+    def __init__(self, fresh_keys: bool = False):
+        if fresh_keys or not self.load():
+            self.generate()
+            self.save()
+        # prime the OPE cipher state so the first add_employee does not pay its setup cost
+        self.ope_key.encrypt(0)
+        self._obfuscators = Queue(maxsize=OBFUSCATOR_POOL_SIZE)
+        Thread(target=self._precompute_obfuscators, daemon=True).start()
+
+    def _precompute_obfuscators(self):
+        public_key = self.phe_public_key
+        while True:
+            random = public_key.get_random_lt_n()
+            self._obfuscators.put(pow(random, public_key.n, public_key.nsquare))
+
+    def encrypt(self, value: int) -> EncryptedNumber:
+        """Encrypt a value with the PHE public key using a precomputed obfuscator"""
+        encoded = EncodedNumber.encode(self.phe_public_key, value)
+        ciphertext = self.phe_public_key.raw_encrypt(encoded.encoding, r_value=1)
+        ciphertext = ciphertext * self._obfuscators.get() % self.phe_public_key.nsquare
+        encrypted = EncryptedNumber(self.phe_public_key, ciphertext, encoded.exponent)
+        encrypted._EncryptedNumber__is_obfuscated = True
+        return encrypted
 
     def generate(self):
         """Generate encryption keys"""
         _LOGGER.info("generating keys")
         try:
-            self.phe_public_key, self.phe_private_key = paillier.generate_paillier_keypair()
-            self.ope_key = OPE(OPE.generate_key())
+            self.phe_public_key, self.phe_private_key = paillier.generate_paillier_keypair(n_length=PHE_KEY_LENGTH)
+            self.ope_key = OPE(OPE.generate_key(), in_range=OPE_IN_RANGE, out_range=OPE_OUT_RANGE)
         except:
             _LOGGER.exception("keys generation failed!")
         _LOGGER.info("keys generated")
 
+    def load(self) -> bool:
+        """Load cached encryption keys from disk"""
+        if not KEY_CACHE_PATH.is_file():
+            return False
+        _LOGGER.info("loading cached keys from %s", KEY_CACHE_PATH)
+        try:
+            with open(KEY_CACHE_PATH, encoding='utf-8') as cache_file:
+                cached_keys = json_loads(cache_file.read())
+            if cached_keys['n'].bit_length() != PHE_KEY_LENGTH:
+                _LOGGER.info("cached keys have a different length, regenerating")
+                return False
+            self.phe_public_key = PaillierPublicKey(n=cached_keys['n'])
+            self.phe_private_key = PaillierPrivateKey(self.phe_public_key, cached_keys['p'], cached_keys['q'])
+            self.ope_key = OPE(b64decode(cached_keys['ope_key']), in_range=OPE_IN_RANGE, out_range=OPE_OUT_RANGE)
+        except:
+            _LOGGER.exception("failed to load cached keys!")
+            return False
+        _LOGGER.info("cached keys loaded")
+        return True
+
+    def save(self):
+        """Cache encryption keys on disk"""
+        _LOGGER.info("caching keys in %s", KEY_CACHE_PATH)
+        try:
+            KEY_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+            with open(KEY_CACHE_PATH, 'w', encoding='utf-8') as cache_file:
+                cache_file.write(json_dumps({
+                    'n': self.phe_public_key.n,
+                    'p': self.phe_private_key.p,
+                    'q': self.phe_private_key.q,
+                    'ope_key': b64encode(self.ope_key.key).decode('utf-8'),
+                }))
+            chmod(KEY_CACHE_PATH, 0o600)
+        except:
+            _LOGGER.exception("failed to cache keys!")
+        _LOGGER.info("keys cached")
+
     def send_public_key(self, client_socket: socket):
         """Send PHE public key to server"""
         _LOGGER.info("sending paillier public key")
         try:
-            serialized_phe_public_key = dumps({'n': self.phe_public_key.n})
-            client_socket.send(serialized_phe_public_key.encode('utf-8'))
+            n = self.phe_public_key.n
+            _send_msg(client_socket, n.to_bytes((n.bit_length() + 7) // 8, 'big'))
         except:
             _LOGGER.exception("failed to send paillier public key!")
         _LOGGER.info("paillier public key sent")
 
 
-@dataclass
+@dataclass(slots=True)
 class Instruction:
     """Instruction object"""
 
     instruction: int = None
     instruction_data: dict = field(default_factory=dict)
     result_data: dict = field(default_factory=dict)
+    _dispatch: dict = field(init=False, repr=False)
+    _rxbuf: bytearray = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._rxbuf = bytearray(4096)
+        self._dispatch = {
+            0: self.quit,
+            1: self.get_table,
+            2: self.add_employee,
+            3: self.compare_employees,
+            4: self.get_salaries_sum,
+        }
+
+    def _recv_frame(self, sock: socket) -> memoryview:
+        """Receive a length-prefixed message into the reusable buffer"""
+        size = int.from_bytes(_recv_exact(sock, 4), 'big')
+        if size > len(self._rxbuf):
+            self._rxbuf = bytearray(size)
+        view = memoryview(self._rxbuf)[:size]
+        _recv_into(sock, view)
+        return view
 
     def read_instruction(self) -> bool:
         """Read instruction from user input"""
@@ -84,74 +216,58 @@ Commands list:
         """Send instruction to server"""
         try:
             self.instruction_data['instruction'] = str(self.instruction)
-            match self.instruction:
-                case 0:
-                    self.quit(client_socket)
-                case 1:
-                    self.get_table(client_socket)
-                case 2:
-                    self.add_employee(client_socket, keys)
-                case 3:
-                    self.compare_employees(client_socket)
-                case 4:
-                    self.get_salaries_sum(client_socket)
-                case _:
-                    _LOGGER.error("wrong input value")
-                    return False
+            self.instruction_data['data'] = None
+            handler = self._dispatch.get(self.instruction)
+            if handler is None:
+                _LOGGER.error("wrong input value")
+                return False
+            handler(client_socket, keys)
         except:
             self.instruction = None
             return False
-        finally:
-            self.instruction_data.clear()
         return True
 
-    def quit(self, client_socket: socket):
+    def quit(self, client_socket: socket, keys: Keys):
         """Quit"""
-        serialized_instruction = dumps(self.instruction_data)
-        client_socket.send(serialized_instruction.encode('utf-8'))
+        _send_msg(client_socket, dumps(self.instruction_data))
 
-    def get_table(self, client_socket: socket):
+    def get_table(self, client_socket: socket, keys: Keys):
         """Get table content"""
-        serialized_instruction = dumps(self.instruction_data)
-        client_socket.send(serialized_instruction.encode('utf-8'))
+        _send_msg(client_socket, dumps(self.instruction_data))
 
     def add_employee(self, client_socket: socket, keys: Keys):
         """Add an employee to database"""
         salary = int(input("New employee's salary: "))
         self.instruction_data['data'] = {
-            'paillier_salary': keys.phe_public_key.encrypt(salary).ciphertext(),
+            'paillier_salary': _int_to_b64(keys.encrypt(salary).ciphertext(), 2 * keys.phe_public_key.n.bit_length()),
             'ope_salary': keys.ope_key.encrypt(salary)
         }
-        serialized_instruction = dumps(self.instruction_data)
-        client_socket.send(serialized_instruction.encode('utf-8'))
+        _send_msg(client_socket, dumps(self.instruction_data))
 
-    def compare_employees(self, client_socket: socket):
+    def compare_employees(self, client_socket: socket, keys: Keys):
         """Compare two employees salaries"""
         self.instruction_data['data'] = {
             'id_1': input("Employee 1: "),
             'id_2': input("Employee 2: ")
         }
-        serialized_instruction = dumps(self.instruction_data)
-        client_socket.send(serialized_instruction.encode('utf-8'))
+        _send_msg(client_socket, dumps(self.instruction_data))
 
-    def get_salaries_sum(self, client_socket: socket):
+    def get_salaries_sum(self, client_socket: socket, keys: Keys):
         """Get sum of two employees salaries"""
         self.instruction_data['data'] = {
             'id_1': input("Employee 1: "),
             'id_2': input("Employee 2: ")
         }
-        serialized_instruction = dumps(self.instruction_data)
-        client_socket.send(serialized_instruction.encode('utf-8'))
+        _send_msg(client_socket, dumps(self.instruction_data))
 
     def read_result(self, client_socket: socket, keys: Keys) -> bool:
         """Read instruction result from server"""
         try:
-            serialized_result = (client_socket.recv(4096)).decode('utf-8')
-            self.result_data = loads(serialized_result)
+            self.result_data = loads(self._recv_frame(client_socket))
             match int(self.result_data['result']):
                 case 0:
                     if 4 == self.instruction:
-                        encrypted_number_received = EncryptedNumber(keys.phe_public_key, int(self.result_data["data"]))
+                        encrypted_number_received = EncryptedNumber(keys.phe_public_key, _b64_to_int(self.result_data["data"]))
                         print(f"\033[94m{keys.phe_private_key.decrypt(encrypted_number_received)}\033[0m")
                     else:
                         print(f"\033[94m{self.result_data['data']}\033[0m")
@@ -167,8 +283,6 @@ Commands list:
                     _LOGGER.error("unknown result code: %s", self.result_data['result'])
         except:
             return False
-        finally:
-            self.result_data.clear()
         return True
 
 
@@ -176,6 +290,7 @@ def _connect_to_server(ip_addr: str, port: int) -> socket:
     _LOGGER.info("connecting to %s:%d", ip_addr, port)
     try:
         client_socket = socket(AF_INET, SOCK_STREAM)
+        client_socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
         client_socket.connect((ip_addr, port))
     except OSError:
         _LOGGER.exception("failed to connect to %s:%d!", ip_addr, port)
@@ -197,16 +312,18 @@ def _parse_args():
     parser = ArgumentParser(description="client")
     parser.add_argument('ip_addr', type=str, help="ip address of server to connect to")
     parser.add_argument('port', type=int, help="port of server to connect to")
+    parser.add_argument('--fresh-keys', action='store_true', help="generate new encryption keys instead of reusing cached ones")
     return parser.parse_args()
 
 
 def app():
     """Application entrypoint"""
     _LOGGER.info("client v%s", VERSION)
+    _LOGGER.info("gmpy2 paillier backend: %s", "enabled" if HAVE_GMP else "disabled")
     args = _parse_args()
 
     client_socket = _connect_to_server(args.ip_addr, args.port)
-    keys = Keys()
+    keys = Keys(args.fresh_keys)
     keys.send_public_key(client_socket)
 
     instruction = Instruction()
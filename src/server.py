@@ -2,25 +2,28 @@
 """
 
 from argparse import ArgumentParser
+from base64 import b64encode, b64decode
 from dataclasses import dataclass, field
 from getpass import getpass
-from json import dumps, loads
-from socket import socket, AF_INET, SOCK_STREAM
+from socket import socket, AF_INET, SOCK_STREAM, IPPROTO_TCP, TCP_NODELAY
+from threading import Thread
 from typing import Tuple
 
 from logging import basicConfig, getLogger
-from mysql.connector import connect
+from orjson import dumps, loads
+from mysql.connector import connect, Error
 from mysql.connector.abstracts import MySQLConnectionAbstract
-from mysql.connector.cursor import MySQLCursor
-from phe import PaillierPublicKey, EncryptedNumber
+from mysql.connector.cursor import MySQLCursor, MySQLCursorPrepared
+from phe import PaillierPublicKey
 from rich.console import Console
+from rich.highlighter import NullHighlighter
 from rich.logging import RichHandler
 
 basicConfig(
     level='INFO',
     format="%(message)s",
     datefmt="[%Y-%m-%dT%H:%M:%S]",
-    handlers=[RichHandler(console=Console(stderr=True))],
+    handlers=[RichHandler(console=Console(stderr=True), markup=False, highlighter=NullHighlighter())],
 )
 
 _LOGGER = getLogger('server')
@@ -32,121 +35,161 @@ DB = 'db_security'
 VERSION = '1.0.0'
 
 
-@dataclass
+def _send_msg(sock: socket, payload: bytes):
+    """Send a message prefixed with its 4-byte big-endian length"""
+    sock.sendall(len(payload).to_bytes(4, 'big') + payload)
+
+
+def _recv_into(sock: socket, view: memoryview):
+    """Receive exactly len(view) bytes from a socket into a buffer"""
+    size = len(view)
+    received = 0
+    while received < size:
+        read = sock.recv_into(view[received:])
+        if read == 0:
+            raise ConnectionError("connection closed while receiving")
+        received += read
+
+
+def _recv_exact(sock: socket, size: int) -> bytes:
+    """Receive exactly size bytes from a socket"""
+    buffer = bytearray(size)
+    _recv_into(sock, memoryview(buffer))
+    return bytes(buffer)
+
+
+def _recv_msg(sock: socket) -> bytes:
+    """Receive a message prefixed with its 4-byte big-endian length"""
+    size = int.from_bytes(_recv_exact(sock, 4), 'big')
+    return _recv_exact(sock, size)
+
+
+def _int_to_b64(value: int, n_bits: int) -> str:
+    """Encode an n_bits-wide integer as base64 big-endian bytes"""
+    return b64encode(value.to_bytes((n_bits + 7) // 8, 'big')).decode('ascii')
+
+
+def _b64_to_int(encoded: str) -> int:
+    """Decode a base64 big-endian bytes integer"""
+    return int.from_bytes(b64decode(encoded), 'big')
+
+
+@dataclass(slots=True)
 class Key:
     """Encryption public key object"""
 
     phe_public_key: PaillierPublicKey = None
+    nsquare: int = None
 
     def read_paillier_public_key(self, server_socket: socket):
         """Read PHE public key from client"""
         _LOGGER.info("waiting to receive Paillier public key...")
         try:
-            serialized_phe_public_key = server_socket.recv(4096)
-            phe_public_key = loads(serialized_phe_public_key.decode('utf-8'))
-            _LOGGER.info("paillier public key received")
-            self.rebuild_pailler_public_key(phe_public_key)
+            serialized_phe_public_key = _recv_msg(server_socket)
+            self.phe_public_key = PaillierPublicKey(n=int.from_bytes(serialized_phe_public_key, 'big'))
+            self.nsquare = self.phe_public_key.nsquare
         except:
             _LOGGER.exception("failed to get paillier public key!")
         _LOGGER.info("paillier public key read")
 
-    def rebuild_pailler_public_key(self, phe_public_key: PaillierPublicKey):
-        """Rebuild PHE Paillier public key"""
-        _LOGGER.info("rebuilding paillier public key...")
-        try:
-            self.phe_public_key = PaillierPublicKey(n=int(phe_public_key['n']))
-        except:
-            _LOGGER.exception("failed to rebuild paillier public key!")
-        _LOGGER.info("paillier public key rebuilt")
 
-
-@dataclass
+@dataclass(slots=True)
 class Instruction:
     """Instruction object"""
 
     instruction: int = None
     instruction_data: dict = field(default_factory=dict)
     result_data: dict = field(default_factory=dict)
+    _dispatch: dict = field(init=False, repr=False)
+    _rxbuf: bytearray = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._rxbuf = bytearray(4096)
+        self._dispatch = {
+            0: self.quit,
+            1: self.get_table,
+            2: self.add_employee,
+            3: self.compare_employees,
+            4: self.get_salaries_sum,
+        }
+
+    def _recv_frame(self, sock: socket) -> memoryview:
+        """Receive a length-prefixed message into the reusable buffer"""
+        size = int.from_bytes(_recv_exact(sock, 4), 'big')
+        if size > len(self._rxbuf):
+            self._rxbuf = bytearray(size)
+        view = memoryview(self._rxbuf)[:size]
+        _recv_into(sock, view)
+        return view
 
     def read_instruction(self, server_socket: socket) -> bool:
         """Read instruction from client"""
         try:
-            serialized_instruction = (server_socket.recv(4096)).decode('utf-8')
-            self.instruction_data = loads(serialized_instruction)
+            self.instruction_data = loads(self._recv_frame(server_socket))
         except:
             self.instruction = None
-            self.result_data['result'] = '1'
+            self.result_data = {'result': '1'}
             return False
         return True
 
-    def execute_instruction(self, db_connect: MySQLConnectionAbstract, db_cursor: MySQLCursor, key: Key) -> bool:
+    def execute_instruction(self, db_connect: MySQLConnectionAbstract, db_cursor: MySQLCursor, prepared_cursor: MySQLCursorPrepared, key: Key) -> bool:
         """Execute instruction"""
         try:
             self.instruction = int(self.instruction_data['instruction'])
-            match self.instruction:
-                case 0:
-                    self.quit()
-                case 1:
-                    _LOGGER.info("instruction received: show tables")
-                    self.get_table(db_cursor)
-                case 2:
-                    _LOGGER.info("instruction received: add a new employee")
-                    self.add_employee(db_connect, db_cursor)
-                case 3:
-                    _LOGGER.info("instruction received: compare two salaries")
-                    self.compare_employees(db_connect, db_cursor)
-                case 4:
-                    _LOGGER.info("instruction received: sum two salaries")
-                    self.get_salaries_sum(db_connect, db_cursor, key)
-                case _:
-                    self.wrong_instruction_value()
+            handler = self._dispatch.get(self.instruction)
+            if handler is None:
+                self.wrong_instruction_value()
+            else:
+                handler(db_connect, db_cursor, prepared_cursor, key)
         except:
             self.instruction = None
-            self.result_data['result'] = '2'
+            self.result_data = {'result': '2'}
             return False
         return True
 
-    def quit(self):
+    def quit(self, db_connect: MySQLConnectionAbstract, db_cursor: MySQLCursor, prepared_cursor: MySQLCursorPrepared, key: Key):
         """Quit"""
         self.result_data['result'] = '0'
         self.result_data['data'] = "quit"
         _LOGGER.info("quit")
 
-    def get_table(self, db_cursor: MySQLCursor):
+    def get_table(self, db_connect: MySQLConnectionAbstract, db_cursor: MySQLCursor, prepared_cursor: MySQLCursorPrepared, key: Key):
         """Get table content"""
+        _LOGGER.info("instruction received: show tables")
         db_cursor.execute('SHOW TABLES;')
         self.result_data['result'] = '0'
-        self.result_data['data'] = db_cursor.fetchall()
+        self.result_data['data'] = [row[0] for row in db_cursor.fetchall()]
 
-    def add_employee(self, db_connect: MySQLConnectionAbstract, db_cursor: MySQLCursor):
+    def add_employee(self, db_connect: MySQLConnectionAbstract, db_cursor: MySQLCursor, prepared_cursor: MySQLCursorPrepared, key: Key):
         """Add an employee to database"""
+        _LOGGER.info("instruction received: add a new employee")
         sql = 'INSERT INTO Employees (phe_salary, ope_salary) VALUES (%s, %s);'
-        db_cursor.execute(sql, (str(self.instruction_data['data']['paillier_salary']), str(self.instruction_data['data']['ope_salary'])))
-        db_connect.commit()
+        data = self.instruction_data['data']
+        prepared_cursor.execute(sql, (b64decode(data['paillier_salary']), int(data['ope_salary'])))
         self.result_data['result'] = '0'
         self.result_data['data'] = "OK"
 
-    def compare_employees(self, db_connect: MySQLConnectionAbstract, db_cursor: MySQLCursor):
+    def compare_employees(self, db_connect: MySQLConnectionAbstract, db_cursor: MySQLCursor, prepared_cursor: MySQLCursorPrepared, key: Key):
         """Compare two employees salaries"""
+        _LOGGER.info("instruction received: compare two salaries")
         sql = 'SELECT id FROM Employees WHERE id IN (%s, %s) ORDER BY ope_salary DESC LIMIT 1;'
-        db_cursor.execute(sql, (int(self.instruction_data['data']['id_1']), int(self.instruction_data['data']['id_2'])))
-        db_connect.commit()
+        data = self.instruction_data['data']
+        prepared_cursor.execute(sql, (int(data['id_1']), int(data['id_2'])))
         self.result_data['result'] = '0'
-        self.result_data['data'] = "Id " + str(db_cursor.fetchone()[0]) + " has a higher salary"
+        self.result_data['data'] = "Id " + str(prepared_cursor.fetchone()[0]) + " has a higher salary"
 
-    def get_salaries_sum(self, db_connect: MySQLConnectionAbstract, db_cursor: MySQLCursor, key: Key):
+    def get_salaries_sum(self, db_connect: MySQLConnectionAbstract, db_cursor: MySQLCursor, prepared_cursor: MySQLCursorPrepared, key: Key):
         """Get sum of two employees salaries"""
+        _LOGGER.info("instruction received: sum two salaries")
         sql = 'SELECT phe_salary FROM Employees WHERE id=%s OR id=%s;'
-        db_cursor.execute(sql, (int(self.instruction_data['data']['id_1']), int(self.instruction_data['data']['id_2'])))
-        db_connect.commit()
-        results = db_cursor.fetchall()
-        first_salary = int(results[0][0])
-        second_salary = int(results[1][0])
-        encrypted_first_salary = EncryptedNumber(key.phe_public_key, first_salary)
-        encrypted_second_salary = EncryptedNumber(key.phe_public_key, second_salary)
-        encrypted_sum = encrypted_first_salary + encrypted_second_salary
+        data = self.instruction_data['data']
+        prepared_cursor.execute(sql, (int(data['id_1']), int(data['id_2'])))
+        results = prepared_cursor.fetchall()
+        first_salary = int.from_bytes(results[0][0], 'big')
+        second_salary = int.from_bytes(results[1][0], 'big')
+        encrypted_sum = first_salary * second_salary % key.nsquare
         self.result_data['result'] = '0'
-        self.result_data['data'] = encrypted_sum.ciphertext()
+        self.result_data['data'] = _int_to_b64(encrypted_sum, 2 * key.phe_public_key.n.bit_length())
 
     def wrong_instruction_value(self):
         """Wrong instruction value"""
@@ -157,15 +200,12 @@ class Instruction:
     def send_result(self, server_socket: socket) -> bool:
         """Send instruction result to client"""
         try:
-            server_socket.send(dumps(self.result_data).encode('utf-8'))
+            _send_msg(server_socket, dumps(self.result_data))
         except:
             self.instruction = None
-            self.result_data.clear()
-            self.result_data['result'] = '3'
-            server_socket.send(dumps(self.result_data).encode('utf-8'))
+            self.result_data = {'result': '3'}
+            _send_msg(server_socket, dumps(self.result_data))
             return False
-        finally:
-            self.result_data.clear()
         _LOGGER.info("result sent")
         return True
 
@@ -174,6 +214,7 @@ def _listen_to(port: int) -> socket:
     _LOGGER.info("starting listening socket %s:%d", HOST, port)
     try:
         listening_socket = socket(AF_INET, SOCK_STREAM)
+        listening_socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
         listening_socket.bind((HOST, port))
         listening_socket.listen()
     except OSError:
@@ -186,13 +227,14 @@ def _accept_connection(listening_socket: socket) -> socket:
     _LOGGER.info("acception incomming connection")
     try:
         server_socket, client_address = listening_socket.accept()
+        server_socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
     except OSError:
         _LOGGER.exception("failed to accept incomming connection from %s!", client_address)
     _LOGGER.info("incomming connection from %s accepted", client_address)
     return server_socket
 
 
-def _connect_to_db() -> Tuple[MySQLConnectionAbstract, MySQLCursor]:
+def _connect_to_db() -> Tuple[MySQLConnectionAbstract, MySQLCursor, MySQLCursorPrepared]:
     _LOGGER.info("connecting to bdd on %s with %s...", DB_HOST, DB_USER)
     try:
         db_connect = connect(
@@ -203,24 +245,29 @@ def _connect_to_db() -> Tuple[MySQLConnectionAbstract, MySQLCursor]:
             charset="utf8mb4",
             collation="utf8mb4_general_ci",
         )
+        db_connect.autocommit = True
         db_cursor = db_connect.cursor(buffered=True)
-    except:
+        prepared_cursor = db_connect.cursor(prepared=True)
+    except Error:
         _LOGGER.exception("failed to connect to %s database with %s", DB_HOST, DB_USER)
 
+    _LOGGER.info("connected to bdd on %s with %s", DB_HOST, DB_USER)
+    return db_connect, db_cursor, prepared_cursor
+
+
+def _init_db():
+    db_connect, db_cursor, prepared_cursor = _connect_to_db()
     try:
         db_cursor.execute("CREATE TABLE IF NOT EXISTS Employees ("
         "id INT AUTO_INCREMENT PRIMARY KEY,"
-        "phe_salary TEXT,"
-        "ope_salary TEXT);")
-        db_connect.commit()
-
-        db_cursor.execute("TRUNCATE Employees;")
-        db_connect.commit()
-    except:
+        "phe_salary VARBINARY(1024),"
+        "ope_salary BIGINT);")
+    except Error:
         _LOGGER.exception("failed to create a new table")
-
-    _LOGGER.info("connected to bdd on %s with %s", DB_HOST, DB_USER)
-    return db_connect, db_cursor
+    finally:
+        prepared_cursor.close()
+        db_cursor.close()
+        db_connect.close()
 
 
 def _parse_args():
@@ -229,16 +276,11 @@ def _parse_args():
     return parser.parse_args()
 
 
-def app():
-    """Application entrypoint"""
-    _LOGGER.info("server v%s", VERSION)
-    args = _parse_args()
-
-    listening_socket = _listen_to(args.port)
-    server_socket = _accept_connection(listening_socket)
+def _handle_client(server_socket: socket):
+    """Serve one client connection until it quits"""
     key = Key()
     key.read_paillier_public_key(server_socket)
-    db_connect, db_cursor = _connect_to_db()
+    db_connect, db_cursor, prepared_cursor = _connect_to_db()
 
     instruction = Instruction()
     try:
@@ -248,7 +290,7 @@ def app():
                 if not instruction.send_result(server_socket):
                     _LOGGER.error("failed to send result")
                 continue
-            if not instruction.execute_instruction(db_connect, db_cursor, key):
+            if not instruction.execute_instruction(db_connect, db_cursor, prepared_cursor, key):
                 _LOGGER.error("failed to execute instruction")
             if not instruction.send_result(server_socket):
                 _LOGGER.error("failed to send result")
@@ -257,9 +299,26 @@ def app():
         _LOGGER.exception("something went wrong!")
 
     finally:
+        prepared_cursor.close()
         db_cursor.close()
         db_connect.close()
         server_socket.close()
+
+
+def app():
+    """Application entrypoint"""
+    _LOGGER.info("server v%s", VERSION)
+    args = _parse_args()
+
+    listening_socket = _listen_to(args.port)
+    _init_db()
+    try:
+        while True:
+            server_socket = _accept_connection(listening_socket)
+            Thread(target=_handle_client, args=(server_socket,), daemon=True).start()
+    except KeyboardInterrupt:
+        _LOGGER.info("shutting down")
+    finally:
         listening_socket.close()
 
 